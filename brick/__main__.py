@@ -1,22 +1,29 @@
 #!/usr/bin/env python3
 
+import functools
 import logging
 import os
+import re
 import shutil
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Set, Tuple
 
 import arrow
 import click
-import docker
-from wcmatch import wcmatch
 
 from .dockerlib import (
     docker_run,
     docker_build,
+    docker_copy_from_image,
     docker_images_list,
     docker_image_delete,
+    get_docker_client,
+    image_exists,
 )
 from .lib import (
+    clear_expanded_inputs,
     get_config,
     get_relative_config_path,
     expand_inputs,
@@ -24,13 +31,10 @@ from .lib import (
     intersecting_outputs,
     get_build_repository_and_tag,
 )
-from .git import GIT_BRANCH
+from .git import get_git_branch
 from .logger import logger, handler
-from .shell import run_shell_command
 
-docker_client = docker.from_env()
-
-# Folder exclude patterns separated by |. (e.g. 'node_modules|dist|whatever')
+# Folders excluded from the search of targets, separated by |. (e.g. 'node_modules|dist|whatever')
 GLOB_EXCLUDES = "node_modules"
 
 YARN_CACHE_LOCATION = "/usr/local/share/.cache/yarn"
@@ -50,7 +54,26 @@ def is_yarn_install_command(cmd):
     return cmd.startswith("yarn") or cmd.startswith("yarn install")
 
 
+# Package manager caches that are mounted on RUN commands using them,
+# so that packages are not downloaded again when a layer is rebuilt.
+# Mounted folders are not part of the image: apt package lists are not kept in it either,
+# so later commands (or containers) must run `apt-get update` before installing packages.
+APT_COMMAND = re.compile(r"\bapt(-get)?\s")
+CACHE_MOUNTS = [
+    (re.compile(r"\bpip3? install\b"), ["target=/root/.cache/pip"]),
+    (re.compile(r"\bnpm (install|ci)\b"), ["target=/root/.npm"]),
+    # apt refuses concurrent access to its cache
+    (
+        APT_COMMAND,
+        ["target=/var/cache/apt,sharing=locked", "target=/var/lib/apt/lists,sharing=locked"],
+    ),
+    (re.compile(r"\bgo (build|install|test|run)\b"), ["target=/root/.cache/go-build"]),
+]
+
+
 timings = []
+# Targets can run in parallel (see --jobs)
+timings_lock = threading.Lock()
 cyan = "\x1b[36;21m"
 green = "\x1b[32;21m"
 yellow = "\x1b[33;21m"
@@ -64,7 +87,8 @@ def log_exec_details(task, target, start, is_cached=False):
     duration_color = red if duration > 10 else green
     cached_message = " (cached)" if is_cached else ""
     text = f"  {duration_color}{duration}s{reset} - {cyan}{task}{reset} of {yellow}{target}{reset}{cached_message}"
-    timings.append(text)
+    with timings_lock:
+        timings.append(text)
 
 
 def compute_tags(name, step_name):
@@ -74,7 +98,7 @@ def compute_tags(name, step_name):
 def add_version_to_tag(name):
     assert ":" not in name, f"Did not expect any tags in {name}"
     latest_tag = f"{name}:latest"
-    branch_tag = f"{name}:{GIT_BRANCH.replace('#', '').replace('/', '-')}"
+    branch_tag = f"{name}:{get_git_branch()}"
     # Last tag should be the most specific
     return [
         latest_tag,
@@ -86,6 +110,25 @@ def get_name(target_rel_path):
     return target_rel_path.replace("/", "_")
 
 
+def generate_copy_instructions(inputs, copy_flag_chown=""):
+    """
+    Files of a same folder are copied with a single COPY instruction, which reduces the number
+    of layers. Folders need their own instruction, as COPY copies the contents of a folder.
+    """
+    sources_by_destination: Dict[str, List[str]] = {}
+    for x in inputs:
+        if os.path.isdir(os.path.join(ROOT_PATH, x)):
+            sources_by_destination[f"/home/{x}"] = [x]
+        else:
+            destination = f"/home/{os.path.join(os.path.dirname(x), '')}"
+            sources_by_destination.setdefault(destination, []).append(x)
+    instructions = []
+    for destination, sources in sources_by_destination.items():
+        quoted_sources = ", ".join([f'"{x}"' for x in sources])
+        instructions.append(f'COPY {copy_flag_chown} [{quoted_sources}, "{destination}"]')
+    return instructions
+
+
 def generate_dockerfile_contents(
     from_image,
     inputs,
@@ -98,33 +141,26 @@ def generate_dockerfile_contents(
     external_images=None,
     environment=None,
     chown=None,
+    cache_mounts=None,
 ):
-    dockerfile_contents = "# syntax = docker/dockerfile:experimental\n"
-    dockerfile_contents += f"FROM {from_image}\n"
+    # Lines are gathered and joined once
+    lines = [f"FROM {from_image}"]
 
     copy_flag_chown = f"--chown={chown}" if chown else ""
 
-    if inputs_from_build:
-        dockerfile_contents += (
-            "\n".join(
-                [
-                    f"COPY {copy_flag_chown} --from={x[0]} /home/{x[1]} /home/{x[1]}"
-                    for x in inputs_from_build
-                ]
-            )
-            + "\n"
-        )
-    dockerfile_contents += (
-        "\n".join([f'COPY {copy_flag_chown} ["{x}", "/home/{x}"]' for x in inputs]) + "\n"
-    )
+    lines += [
+        f"COPY {copy_flag_chown} --from={x[0]} /home/{x[1]} /home/{x[1]}"
+        for x in inputs_from_build or []
+    ]
+    lines += generate_copy_instructions(inputs, copy_flag_chown)
     # External images
     # https://docs.docker.com/develop/develop-images/multistage-build/#use-an-external-image-as-a-stage
-    for k, v in (external_images or {}).items():
-        dockerfile_contents += (
-            f'COPY {copy_flag_chown} --from={v["tag"]} {v["src"]} {v["target"]}\n'
-        )
+    lines += [
+        f'COPY {copy_flag_chown} --from={v["tag"]} {v["src"]} {v["target"]}'
+        for v in (external_images or {}).values()
+    ]
 
-    dockerfile_contents += f"WORKDIR /home/{workdir or ''}\n"
+    lines.append(f"WORKDIR /home/{workdir or ''}")
     run_flags = []
     if pass_ssh:
         run_flags += ["--mount=type=ssh"]
@@ -133,23 +169,37 @@ def generate_dockerfile_contents(
         # Use the tar file passed instead
         # Note: One could use --mount-type=bind if the secrets
         # were placed in the build context
-        run_flags += [f'--mount=type=secret,id={k},target={v["target"]}.tar.gz,required']
-
-    for k, v in (environment or {}).items():
-        dockerfile_contents += f"ENV {k}='{v}'\n"
+        run_flags += [f'--mount=type=secret,id={k},target={v["target"]}.tar,required']
+
+    lines += [f"ENV {k}='{v}'" for k, v in (environment or {}).items()]
+    if any(APT_COMMAND.search(cmd) for cmd in commands):
+        # Debian based images delete downloaded packages after each install (and `apt` does too
+        # by default), which would leave the apt cache mount empty.
+        # Images running as another user than root can't change the apt configuration.
+        lines.append(
+            'RUN if [ "$(id -u)" = 0 ]; then rm -f /etc/apt/apt.conf.d/docker-clean && '
+            "echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' "
+            "> /etc/apt/apt.conf.d/keep-cache; fi"
+        )
 
     def generate_run_command(cmd, run_flags):
+        # Cache mounts only apply to this command
+        run_flags = list(run_flags)
         cache_version = IMAGES_TO_YARN_CACHE_VERSION_DICT.get(from_image)
         if is_yarn_install_command(cmd) and cache_version:
             location = f"{YARN_CACHE_LOCATION}/{cache_version}"
             logger.debug(f"Using yarn cache located at {location}")
             run_flags += [f"--mount=type=cache,target={location}"]
+        for pattern, mounts in CACHE_MOUNTS:
+            if pattern.search(cmd):
+                run_flags += [f"--mount=type=cache,{mount}" for mount in mounts]
+        run_flags += [f"--mount=type=cache,target={target}" for target in cache_mounts or []]
         if (secrets or {}).items():
             # Wrap the run command with a tar command
             # to untar and cleanup after us
             pre = " && ".join(
                 [
-                    f'mkdir -p {v["target"]} && tar zxf {v["target"]}.tar.gz -C{v["target"]}'
+                    f'mkdir -p {v["target"]} && tar xf {v["target"]}.tar -C{v["target"]}'
                     for k, v in (secrets or {}).items()
                 ]
             )
@@ -162,38 +212,193 @@ def generate_dockerfile_contents(
         else:
             return f"RUN {' '.join(run_flags + [cmd])}"
 
-    dockerfile_contents += (
-        "\n".join([generate_run_command(cmd, run_flags) for cmd in commands]) + "\n"
-    )
+    run_commands = [generate_run_command(cmd, run_flags) for cmd in commands]
+    lines += run_commands
     # Add entrypoint
     if entrypoint:
-        dockerfile_contents += f"CMD {entrypoint}"
+        lines.append(f"CMD {entrypoint}")
+
+    # RUN --mount requires the experimental frontend, which BuildKit must resolve (and pull
+    # on a fresh machine): only ask for it when needed
+    if any("--mount=" in x for x in run_commands):
+        lines.insert(0, "# syntax = docker/dockerfile:experimental")
+
+    return "\n".join(lines) + "\n"
+
+
+def find_build_files(root):
+    """
+    Yields the BUILD.yaml files below root.
+    Excluded and hidden folders (e.g. .git) are pruned, so they are never walked.
+    """
+    excluded_folders = GLOB_EXCLUDES.split("|")
+    folders = [root]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in excluded_folders and not entry.name.startswith("."):
+                        folders.append(entry.path)
+                elif entry.name == "BUILD.yaml":
+                    yield entry.path
+
+
+@functools.lru_cache(maxsize=None)
+def find_targets(target):
+    """
+    Returns the folders containing a BUILD.yaml below target.
+    The workspace is walked once per invocation, whichever command asks for it.
+    """
+    return [os.path.dirname(x) for x in sorted(find_build_files(target))]
+
+
+def get_jobs(ctx):
+    """
+    Number of targets that can run in parallel (--jobs)
+    """
+    jobs = ctx.find_root().params.get("jobs", 1)
+    return jobs if jobs != 0 else os.cpu_count() or 1
+
+
+invocation_state_lock = threading.Lock()
+
+
+def get_invocation_state(ctx):
+    """
+    State shared by all commands (and threads) of a brick invocation.
+    cli creates it before any thread starts. The lock covers commands invoked without cli,
+    where threads could otherwise each create their own state.
+    """
+    with invocation_state_lock:
+        return ctx.find_root().ensure_object(dict)
+
+
+target_locks: Dict[str, Any] = {}
+target_locks_lock = threading.Lock()
+
+
+def get_target_lock(target_path):
+    # Held while building the target, so that other threads wait for its result.
+    # Circular dependencies must be detected before waiting (see build)
+    with target_locks_lock:
+        return target_locks.setdefault(target_path, threading.Lock())
 
-    return dockerfile_contents
+
+# Targets being built by the current thread, or by the thread waiting on it for a dependency
+building_targets = threading.local()
+
+
+def get_building_targets() -> Tuple[str, ...]:
+    return getattr(building_targets, "chain", ())
+
+
+def get_build_dependencies(target):
+    """
+    Returns the absolute paths of the targets whose outputs are inputs of the build step of target
+    """
+    target_rel_path = os.path.relpath(target, start=ROOT_PATH)
+    inputs = get_config(target)["steps"].get("build", {}).get("inputs", [])
+    return [os.path.join(ROOT_PATH, x) for x in intersecting_outputs(target_rel_path, inputs)]
+
+
+def get_dependency_graph(targets):
+    """
+    Returns the build dependencies of targets and of all the targets they depend on
+    """
+    graph: Dict[str, List[str]] = {}
+    to_visit = [os.path.abspath(t) for t in targets]
+    while to_visit:
+        t = to_visit.pop()
+        if t not in graph:
+            graph[t] = get_build_dependencies(t)
+            to_visit += graph[t]
+    return graph
+
+
+def check_circular_dependencies(graph: Dict[str, List[str]]):
+    remaining = dict(graph)
+    done: Set[str] = set()
+    while remaining:
+        ready = [t for t, dependencies in remaining.items() if done.issuperset(dependencies)]
+        if not ready:
+            circular_targets = sorted(os.path.relpath(t, start=ROOT_PATH) for t in remaining)
+            raise Exception(f"Found circular dependencies between {circular_targets}")
+        for t in ready:
+            del remaining[t]
+            done.add(t)
+
+
+def run_in_dependency_order(run, dependencies: Dict[str, List[str]], jobs):
+    """
+    Calls run on every key of dependencies using a pool of jobs threads.
+    A key only starts once the keys it depends on are done. The first failure is raised.
+    """
+    dependencies = dict(dependencies)
+    done: Set[str] = set()
+    running: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while dependencies or running:
+            for t in sorted(dependencies):
+                if done.issuperset(dependencies[t]):
+                    del dependencies[t]
+                    running[executor.submit(run, t)] = t
+            if not running:
+                raise Exception(f"Found circular dependencies between {sorted(dependencies)}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                # Raises if the target failed
+                future.result()
+                done.add(running.pop(future))
+
+
+def run_targets_in_parallel(ctx, fun, targets, jobs):
+    """
+    Runs fun on targets using a pool of jobs threads (workers mostly wait on the docker daemon).
+    A target only starts once the targets its build step depends on are done.
+    Builds still build their own dependencies when they need to (see build_target),
+    like sequential runs do.
+    """
+    requested_targets = [os.path.abspath(t) for t in targets]
+    dependencies: Dict[str, List[str]] = {t: [] for t in requested_targets}
+    if fun in [build, test, deploy]:
+        graph = get_dependency_graph(requested_targets)
+        check_circular_dependencies(graph)
+        for t in requested_targets:
+            # Dependencies outside of targets can link targets together
+            to_visit = list(graph[t])
+            visited: Set[str] = set()
+            while to_visit:
+                dependency = to_visit.pop()
+                if dependency not in visited:
+                    visited.add(dependency)
+                    to_visit += graph[dependency]
+            dependencies[t] = sorted(visited.intersection(requested_targets))
+
+    def run_target(t):
+        ctx.invoke(fun, target=t, skip_previous_steps=ctx.parent.params.get("skip_previous_steps"))
+
+    run_in_dependency_order(run_target, dependencies, jobs)
 
 
 def check_recursive(ctx, target, fun):
     if ctx.parent.params.get("recursive"):
         start = time.perf_counter()
-        targets = [
-            os.path.dirname(x)
-            for x in sorted(
-                wcmatch.WcMatch(
-                    f"{target}", "BUILD.yaml", GLOB_EXCLUDES, flags=wcmatch.RECURSIVE
-                ).match()
-            )
-        ]
+        targets = find_targets(target)
         logger.info(f"Found {len(targets)} target(s)..")
-        for recursive_target in targets:
-            # Note: the recursive parameter will not be passed
-            # and thus the recursion will end here
-            # However, we need to pass other parent parameters
-            # manually
-            ctx.invoke(
-                fun,
-                target=recursive_target,
-                skip_previous_steps=ctx.parent.params.get("skip_previous_steps"),
-            )
+        jobs = get_jobs(ctx)
+        if jobs > 1:
+            run_targets_in_parallel(ctx, fun, targets, jobs)
+        else:
+            for recursive_target in targets:
+                # Note: the recursive parameter will not be passed
+                # and thus the recursion will end here
+                # However, we need to pass other parent parameters
+                # manually
+                ctx.invoke(
+                    fun,
+                    target=recursive_target,
+                    skip_previous_steps=ctx.parent.params.get("skip_previous_steps"),
+                )
         end = time.perf_counter()
         logger.info(f"🌟 All targets finished in {round(end - start, 2)} seconds")
         logger.info("Detailed timing:")
@@ -203,40 +408,34 @@ def check_recursive(ctx, target, fun):
         return True
 
 
-def image_exists(tag):
-    try:
-        docker_client.images.get(tag)
-        return True
-    except docker.errors.ImageNotFound:
-        return False
-
-
 @click.group()
 @click.option("--skip-previous-steps", help="skips previous steps", is_flag=True)
 @click.option("--verbose", help="verbose", is_flag=True)
 @click.option("-r", "--recursive", help="recursive", is_flag=True)
-def cli(verbose, recursive, skip_previous_steps):
+@click.option(
+    "-j",
+    "--jobs",
+    help="number of targets (or dependencies) to run in parallel, 0 for one per CPU",
+    default=1,
+)
+@click.pass_context
+def cli(ctx, verbose, recursive, skip_previous_steps, jobs):
+    get_invocation_state(ctx).setdefault("built_targets", {})
+
     if skip_previous_steps:
         logger.debug(f"Skipping previous steps if possible..")
 
-    if verbose:
-        handler.setLevel(logging.DEBUG)
-    else:
-        handler.setLevel(logging.INFO)
+    # The logger level is set too, so that debug records are not even created when not verbose
+    level = logging.DEBUG if verbose else logging.INFO
+    logger.setLevel(level)
+    handler.setLevel(level)
 
 
 @cli.command("list")  # NOTE: to not redefining built-in 'list'
 @click.argument("target", default=".")
 @click.pass_context
 def list_(ctx, target):
-    targets = [
-        os.path.dirname(x)
-        for x in sorted(
-            wcmatch.WcMatch(
-                f"{target}", "BUILD.yaml", GLOB_EXCLUDES, flags=wcmatch.RECURSIVE
-            ).match()
-        )
-    ]
+    targets = find_targets(target)
     logger.info(f"Found {len(targets)} target(s):")
     for t in targets:
         logger.info(t)
@@ -273,13 +472,18 @@ def prepare(ctx, target, skip_previous_steps=None):
         environment=step.get("environment", {}),
         workdir=target_rel_path,
         chown=step.get("chown"),
+        cache_mounts=step.get("cache_mounts"),
     )
 
     # Docker build
     logger.info(f"🔨 {target_rel_path}: Prepare")
     tags = compute_tags(name, "prepare")
     digest, is_cached = docker_build(
-        tags=tags, dependency_paths=dependency_paths, dockerfile_contents=dockerfile_contents
+        tags=tags,
+        dependency_paths=dependency_paths,
+        dockerfile_contents=dockerfile_contents,
+        cache_from=tags,
+        pull_cache_from=step.get("cache_from"),
     )
     logger.info(f"   {target_rel_path}: Prepare finished{' (cached)' if is_cached else ''}")
     log_exec_details("prepare", target_rel_path, start_time, is_cached)
@@ -294,6 +498,27 @@ def build(ctx, target, skip_previous_steps=None):
     if check_recursive(ctx, target, build):
         return
 
+    target_path = os.path.abspath(target)
+    chain = get_building_targets()
+    if target_path in chain:
+        circular_targets = [
+            os.path.relpath(t, start=ROOT_PATH) for t in chain[chain.index(target_path) :]
+        ]
+        raise Exception(f"Found circular dependencies between {circular_targets}")
+
+    # A target is built once per invocation, even if several targets depend on it
+    built_targets = get_invocation_state(ctx).setdefault("built_targets", {})
+    with get_target_lock(target_path):
+        if target_path not in built_targets:
+            building_targets.chain = chain + (target_path,)
+            try:
+                built_targets[target_path] = build_target(ctx, target, skip_previous_steps)
+            finally:
+                building_targets.chain = chain
+    return built_targets[target_path]
+
+
+def build_target(ctx, target, skip_previous_steps=None):
     start_time = time.perf_counter()
     target_rel_path = os.path.relpath(target, start=ROOT_PATH)
     config = get_config(target)
@@ -317,9 +542,33 @@ def build(ctx, target, skip_previous_steps=None):
     dependencies = intersecting_outputs(target_rel_path, step.get("inputs", []))
     if dependencies:
         logger.debug(f"Found dependencies: {dependencies}")
-        for dependency in dependencies:
+
+        chain = get_building_targets()
+
+        def build_dependency(dependency):
             logger.info(f"➡️  {target_rel_path}: Building dependency {dependency}")
-            ctx.invoke(build, target=os.path.join(ROOT_PATH, dependency))
+            # Pool threads build on behalf of this one
+            thread_chain = get_building_targets()
+            building_targets.chain = chain
+            try:
+                ctx.invoke(
+                    build,
+                    target=os.path.join(ROOT_PATH, dependency),
+                    skip_previous_steps=skip_previous_steps,
+                )
+            finally:
+                building_targets.chain = thread_chain
+
+        jobs = get_jobs(ctx)
+        if jobs > 1 and len(dependencies) > 1:
+            # Threads building dependencies of each other would wait on each other forever
+            check_circular_dependencies(get_dependency_graph([target]))
+            # Dependencies shared by several of them are built once (see build)
+            with ThreadPoolExecutor(max_workers=min(jobs, len(dependencies))) as executor:
+                list(executor.map(build_dependency, dependencies))
+        else:
+            for dependency in dependencies:
+                build_dependency(dependency)
 
     # Note build dependencies must be done pre-glob
     # as else globs might return nothing (if they have not been built)
@@ -338,6 +587,7 @@ def build(ctx, target, skip_previous_steps=None):
         external_images=step.get("external_images"),
         workdir=target_rel_path,
         chown=step.get("chown"),
+        cache_mounts=step.get("cache_mounts"),
     )
 
     # Docker build
@@ -355,14 +605,18 @@ def build(ctx, target, skip_previous_steps=None):
     tags = compute_tags(name, "build") + additional_tags
 
     digest, is_cached = docker_build(
-        tags=tags, dependency_paths=dependency_paths, dockerfile_contents=dockerfile_contents
+        tags=tags,
+        dependency_paths=dependency_paths,
+        dockerfile_contents=dockerfile_contents,
+        cache_from=compute_tags(name, "build") + compute_tags(name, "prepare"),
+        pull_cache_from=step.get("cache_from"),
     )
 
     # TODO: We could skip gathering the output if build did not run AND output folders are up to date
 
     # Gather output
-    for output in step.get("outputs", []):
-        logger.debug(f"Collecting {os.path.join(target_rel_path, output)} from {digest}")
+    outputs = step.get("outputs", [])
+    for output in outputs:
         # Make sure we check that outputs are in this folder,
         # as else the dependency system won't work
         if os.path.abspath(os.path.join(ROOT_PATH, target_rel_path)) not in os.path.abspath(
@@ -370,18 +624,23 @@ def build(ctx, target, skip_previous_steps=None):
         ):
             raise Exception(f"Output {output} is not in current folder")
 
-        host_path = os.path.join(ROOT_PATH, target_rel_path, output)
-        container_path = f"/home/{os.path.join(target_rel_path, output)}"
-        if os.path.exists(host_path):
-            if os.path.isdir(host_path):
-                shutil.rmtree(host_path)
-            else:
-                os.remove(host_path)
-
-        host_output_folder = os.path.abspath(os.path.join(host_path, "../"))
-        container_id = run_shell_command(f"docker create {digest}")
-        run_shell_command(f"docker cp {container_id}:{container_path} {host_output_folder}")
-        run_shell_command(f"docker rm -v {container_id}")
+    if outputs:
+        paths = []
+        for output in outputs:
+            logger.debug(f"Collecting {os.path.join(target_rel_path, output)} from {digest}")
+            host_path = os.path.join(ROOT_PATH, target_rel_path, output)
+            container_path = f"/home/{os.path.join(target_rel_path, output)}"
+            if os.path.exists(host_path):
+                if os.path.isdir(host_path):
+                    shutil.rmtree(host_path)
+                else:
+                    os.remove(host_path)
+
+            host_output_folder = os.path.abspath(os.path.join(host_path, "../"))
+            paths.append((container_path, host_output_folder))
+        docker_copy_from_image(digest, paths)
+        # Outputs might match the inputs of other steps and targets
+        clear_expanded_inputs()
 
     logger.info(f"   {target_rel_path}: Build finished{' (cached)' if is_cached else ''}")
     log_exec_details("build", target_rel_path, start_time, is_cached)
@@ -424,6 +683,7 @@ def test(ctx, target, skip_previous_steps=None):
         workdir=target_rel_path,
         environment=step.get("environment", {}),
         chown=step.get("chown"),
+        cache_mounts=step.get("cache_mounts"),
     )
 
     # Docker build
@@ -432,6 +692,8 @@ def test(ctx, target, skip_previous_steps=None):
         tags=compute_tags(name, "test"),
         dependency_paths=dependency_paths,
         dockerfile_contents=dockerfile_contents,
+        cache_from=compute_tags(name, "test") + compute_tags(name, "build"),
+        pull_cache_from=step.get("cache_from"),
     )
     logger.info(f"✅ {target_rel_path}: Test finished{' (cached)' if is_cached else ''}")
     log_exec_details("test", target_rel_path, start_time, is_cached)
@@ -483,7 +745,7 @@ def deploy(ctx, target, no_cache, skip_previous_steps=None):
 
         logger.info(f"📡 {target_rel_path}: Pushing {repository}:{tag}")
 
-        for line in docker_client.images.push(repository, tag=tag, stream=True, decode=True):
+        for line in get_docker_client().images.push(repository, tag=tag, stream=True, decode=True):
             if "errorDetail" in line:
                 raise Exception(line["errorDetail"]["message"])
             logger.debug(line)
@@ -500,8 +762,12 @@ def deploy(ctx, target, no_cache, skip_previous_steps=None):
         from_image = step["image"]
         # Prepare command to gather the input and output of build step
         outputs = steps.get("build", {}).get("outputs", [])
+        # Outputs within the target folder are already copied along with it:
+        # only those outside of it need their own COPY instruction (and layer)
+        outputs = [o for o in outputs if os.path.normpath(o).split(os.sep)[0] == ".."]
         inputs_from_build = [
-            (previous_tag, os.path.join(target_rel_path, o)) for o in ["."] + outputs
+            (previous_tag, os.path.normpath(os.path.join(target_rel_path, o)))
+            for o in ["."] + outputs
         ]
 
     dockerfile_contents = generate_dockerfile_contents(
@@ -513,6 +779,7 @@ def deploy(ctx, target, no_cache, skip_previous_steps=None):
         pass_ssh=step.get("pass_ssh", False),
         secrets=step.get("secrets"),
         chown=step.get("chown"),
+        cache_mounts=step.get("cache_mounts"),
     )
 
     # Docker build
@@ -525,6 +792,8 @@ def deploy(ctx, target, no_cache, skip_previous_steps=None):
         pass_ssh=step.get("pass_ssh", False),
         secrets=step.get("secrets"),
         no_cache=no_cache,
+        cache_from=compute_tags(name, "deploy"),
+        pull_cache_from=step.get("cache_from"),
     )
     logger.info(f"  {target_rel_path}: Deploy finished{' (cached)' if is_cached else ''}")
 
@@ -591,15 +860,21 @@ def prune(ctx, target, skip_previous_steps=None):
     if skip_previous_steps is None:
         skip_previous_steps = ctx.parent.params.get("skip_previous_steps")
 
+    image_ids_to_delete = []
     for image in docker_images_list(name, last_tagged_before=arrow.utcnow().shift(days=-3)):
         # If no tag contains `master` or `latest`,
         # then this must be a branch build,
         # and it can be considered for deletion
-        if any([":master" in t or ":latest" in t for t in image["tags"]]):
+        if any(":master" in t or ":latest" in t for t in image["tags"]):
             logger.info(f'Skipping {image["tags"][0]}..')
             continue
         logger.info(f'Deleting {image["tags"][0]} ({round(image["size"] / 1024 / 1024)}M)..')
-        docker_image_delete(image["id"], force=True)
+        image_ids_to_delete.append(image["id"])
+
+    # Deletions only wait on the docker daemon: run them concurrently
+    if image_ids_to_delete:
+        with ThreadPoolExecutor(max_workers=min(8, len(image_ids_to_delete))) as executor:
+            list(executor.map(lambda x: docker_image_delete(x, force=True), image_ids_to_delete))
 
     log_exec_details("prune", target_rel_path, start_time)
 
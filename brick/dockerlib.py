@@ -1,40 +1,230 @@
+import atexit
+import functools
+import io
+import logging
 import os
+import posixpath
 import re
+import shlex
+import tarfile
 import tempfile
 import subprocess
 import sys
+import threading
 
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 import docker
 import arrow
 
 from .lib import ROOT_PATH, compute_hash_from_paths
 from .logger import logger
 
-docker_client = docker.from_env()
+
+@functools.lru_cache(maxsize=1)
+def get_docker_client() -> docker.DockerClient:
+    """
+    Connecting to the docker daemon is done on first use only,
+    as some commands (e.g. --help) never need it
+    """
+    return docker.from_env()
+
+
+_known_tags: Optional[Set[str]] = None
+_known_tags_lock = threading.Lock()
+
+
+def get_known_tags() -> Set[str]:
+    """
+    Tags of the local images.
+    They are listed once and then kept up to date, as checking tags one by one
+    would cost a daemon round-trip each.
+    """
+    # pylint: disable=global-statement
+    global _known_tags
+    with _known_tags_lock:
+        if _known_tags is None:
+            _known_tags = {t for image in get_docker_client().images.list() for t in image.tags}
+        return _known_tags
+
+
+# Ids of the local images, by name
+_image_ids: Dict[str, str] = {}
+# Tags of the local images built by brick, by dependency hash
+_hashed_images: Optional[Dict[str, List[str]]] = None
+
+
+def forget_known_tags():
+    # pylint: disable=global-statement
+    global _known_tags, _hashed_images
+    with _known_tags_lock:
+        _known_tags = None
+        _image_ids.clear()
+        _hashed_images = None
+
+
+def image_exists(tag: str) -> bool:
+    if "@" in tag:
+        # Digests are not part of the listed tags
+        try:
+            get_docker_client().images.get(tag)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+    if ":" not in tag.rsplit("/", 1)[-1]:
+        tag = f"{tag}:latest"
+    return tag in get_known_tags()
+
+
+def pull_image(image: str):
+    get_docker_client().images.pull(image)
+    # The pulled tag is not known yet
+    forget_known_tags()
 
 
 def docker_run(tag, command, volumes=None, ports=None, environment=None):
-    cmd = 'docker run --rm -ti --entrypoint=""'
-    if volumes:
-        cmd += f' {" ".join([f"-v {os.path.abspath(v)}:/home/{os.path.relpath(v, ROOT_PATH)}" for v in volumes])}'
-    if ports:
-        cmd += f' {" ".join([f"-p {p}:{p}" for p in ports])}'
-    if environment:
-        cmd += f' {" ".join([f"-e {k}={v}" for k, v in environment.items()])}'
-    cmd += f" {tag} {command}"
-    sys.exit(subprocess.run(cmd, shell=True, check=False).returncode)
+    # docker is executed directly, without going through a shell
+    cmd = ["docker", "run", "--rm", "-ti", "--entrypoint="]
+    for v in volumes or []:
+        cmd += ["-v", f"{os.path.abspath(v)}:/home/{os.path.relpath(v, ROOT_PATH)}"]
+    for p in ports or []:
+        cmd += ["-p", f"{p}:{p}"]
+    for k, v in (environment or {}).items():
+        cmd += ["-e", f"{k}={v}"]
+    cmd += [tag] + shlex.split(command or "")
+    sys.exit(subprocess.run(cmd, check=False).returncode)
 
 
 def tag_image(image_name: str, tags: List[str]):
-    image = docker_client.images.get(image_name)
-    for tag in tags:
+    image = get_docker_client().images.get(image_name)
+
+    def tag(tag):
         logger.debug(f"Tagging {image_name} with {tag}")
+        if tag in image.tags:
+            # Already pointing at the image
+            return
         repository, version = tag.split(":")
         assert repository
         assert version
         image.tag(repository=repository, tag=version)
 
+    # Each tag is a separate request to the daemon: send them concurrently
+    with ThreadPoolExecutor(max_workers=min(8, len(tags) or 1)) as executor:
+        list(executor.map(tag, tags))
+    get_known_tags().update(tags)
+    with _known_tags_lock:
+        _image_ids.update({tag: image.id for tag in tags})
+        if _hashed_images is not None:
+            # The tags moved from whichever image they were on
+            for hash_tags in _hashed_images.values():
+                hash_tags[:] = [t for t in hash_tags if t not in tags]
+            dependency_hash = image.labels.get("brick.dependency_hash")
+            if dependency_hash:
+                _hashed_images.setdefault(dependency_hash, []).extend(tags)
+
+
+def exclude_logs(tarinfo: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+    # Same as `tar --exclude='logs'`
+    return None if os.path.basename(tarinfo.name) == "logs" else tarinfo
+
+
+def write_secret_tarfile(src: str, tarfile_path: str):
+    # For now we tar the whole secrets directory
+    # as buildkit doesn't support mounting directories
+    # See https://github.com/moby/buildkit/issues/970
+    # Secrets are small: skip compression
+    with tarfile.open(tarfile_path, "w") as tar:
+        tar.add(src, arcname=".", filter=exclude_logs)
+
+
+# Secrets tar files, by source directory and newest modification time within it
+_secret_tarfiles: Dict[Tuple[str, int], str] = {}
+_secret_tarfiles_lock = threading.Lock()
+
+
+def get_newest_mtime(src: str) -> int:
+    # Directory mtimes change when entries are added or removed
+    newest = os.lstat(src).st_mtime_ns
+    for dirpath, dirnames, filenames in os.walk(src):
+        for name in dirnames + filenames:
+            newest = max(newest, os.lstat(os.path.join(dirpath, name)).st_mtime_ns)
+    return newest
+
+
+def get_secret_tarfile(src: str) -> str:
+    """
+    Returns a tar file of the secrets directory,
+    only archived again when its content has changed since the last build
+    """
+    key = (src, get_newest_mtime(src))
+    with _secret_tarfiles_lock:
+        if key in _secret_tarfiles:
+            return _secret_tarfiles[key]
+    fd, tarfile_path = tempfile.mkstemp(prefix="brick-secret-", suffix=".tar")
+    os.close(fd)
+    try:
+        write_secret_tarfile(src, tarfile_path)
+    except BaseException:
+        os.remove(tarfile_path)
+        raise
+    with _secret_tarfiles_lock:
+        stale = [k for k in _secret_tarfiles if k[0] == src and k != key]
+        for k in stale:
+            os.remove(_secret_tarfiles.pop(k))
+        if key in _secret_tarfiles:
+            # Archived concurrently by another build
+            os.remove(tarfile_path)
+        else:
+            _secret_tarfiles[key] = tarfile_path
+        return _secret_tarfiles[key]
+
+
+@atexit.register
+def remove_secret_tarfiles():
+    with _secret_tarfiles_lock:
+        for tarfile_path in _secret_tarfiles.values():
+            os.remove(tarfile_path)
+        _secret_tarfiles.clear()
+
+
+# BuildKit progress lines, e.g. "#9 [3/6] COPY ...."
+STEP_ID = re.compile(r"#(?P<id>\d+)")
+STEP_ID_AND_COMMAND = re.compile(r"#(?P<id>\d+) \[.*(?P<number>\d+)/\d+\] (?P<command>.*)")
+
+
+def read_lines(fd: int) -> Iterator[str]:
+    # Large reads mean few syscalls, even when the output is chatty
+    pending = b""
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode("utf8", errors="replace")
+    if pending:
+        yield pending.decode("utf8", errors="replace")
+
+
+def get_cache_images(local_images: List[str], remote_images: List[str]) -> List[str]:
+    """
+    Returns the local_images that exist and the remote_images, pulled if missing
+    so that fresh machines (e.g. CI runners) can reuse their layers.
+    Images that can't be pulled are skipped, as the cache is only an optimization.
+    """
+    cache_images = [image for image in local_images if image_exists(image)]
+    for image in remote_images:
+        if not image_exists(image):
+            logger.debug(f"Pulling down cache image {image}")
+            try:
+                pull_image(image)
+            except docker.errors.APIError as e:
+                logger.debug(f"Could not pull cache image {image}: {e}")
+                continue
+        cache_images.append(image)
+    return cache_images
+
 
 def docker_build(
     tags: List[str],
@@ -43,7 +233,14 @@ def docker_build(
     no_cache=False,
     secrets=None,
     dependency_paths=None,
+    cache_from: Optional[List[str]] = None,
+    pull_cache_from: Optional[List[str]] = None,
 ) -> Tuple[str, bool]:
+    """
+    Builds and tags an image, unless images built from the same dependencies exist.
+    BuildKit reuses the layers (--cache-from) of the cache_from images that exist locally,
+    and of the pull_cache_from images, pulled if missing (see get_cache_images).
+    """
     # pylint: disable=too-many-branches
     tag_to_return = tags[-1]  # Not sure why we return an argument the caller provided
     is_cached = True  # True by default
@@ -59,22 +256,21 @@ def docker_build(
         f"{from_image_id}/{compute_hash_from_paths(dependency_paths)}" if dependency_paths else None
     )
     if dependency_hash:
-        dockerfile_contents += f'\nLABEL brick.dependency_hash="{dependency_hash}"'
         images_matching_hash = get_image_names_with_dependency_hash(dependency_hash)
         logger.debug(
             f"Found {len(images_matching_hash)} image(s) matching dependency hash {dependency_hash} ({images_matching_hash[0:5]}..)"
         )
 
-        images_are_build = set(tags).issubset(set(images_matching_hash))
+        images_are_build = frozenset(tags).issubset(images_matching_hash)
         if images_are_build:
             logger.debug(f"Skipping docker build as images are up to date with input dependencies")
             return tag_to_return, is_cached
 
         # Investigate if we can promote an image instead of building it again
         # We base this on the image name of the images matching the hash
-        image_names = {t.split(":")[0] for t in tags}
+        image_names = frozenset(t[: t.rindex(":")] for t in tags)
         images_matching_hash_and_name = [
-            image for image in images_matching_hash if image.split(":")[0] in image_names
+            image for image in images_matching_hash if image[: image.rindex(":")] in image_names
         ]
 
         if images_matching_hash_and_name:
@@ -83,124 +279,197 @@ def docker_build(
             tag_image(image_name=first_image_matching_hash_and_name, tags=tags)
             return tag_to_return, is_cached
 
-    dockerfile_path = os.path.join(ROOT_PATH, ".brickdockerfile")
-    if os.path.exists(dockerfile_path):
-        logger.warning(f"{dockerfile_path} already exists at root of workspace")
-        os.remove(dockerfile_path)
-    with open(dockerfile_path, "w+") as dockerfile:
-        dockerfile.write(dockerfile_contents)
+    fd, iidfile = tempfile.mkstemp(prefix="brick-iid-")
+    os.close(fd)
     try:
-        iidfile = tempfile.mktemp()
-        cmd = f"docker build . --iidfile {iidfile} -f {dockerfile_path} --progress plain"
+        # docker is executed directly, without going through a shell
+        # The Dockerfile is passed through stdin: nothing is written to the workspace
+        cmd = ["docker", "build", ".", "--iidfile", iidfile, "-f", "-"]
+        cmd += ["--progress", "plain"]
         env = {"DOCKER_BUILDKIT": "1", "HOME": os.environ["HOME"], "PATH": os.environ["PATH"]}
         if pass_ssh:
-            cmd += " --ssh default"
+            cmd += ["--ssh", "default"]
             env["SSH_AUTH_SOCK"] = os.environ["SSH_AUTH_SOCK"]
         if no_cache:
-            cmd += " --no-cache"
-        for k, v in (secrets or {}).items():
-            src = os.path.expanduser(v["src"])
-            # cmd += f' --secret id={k},src={src}'
-            # For now we tar the whole secrets directory
-            # as buildkit doesn't support mounting directories
-            # See https://github.com/moby/buildkit/issues/970
-            basename = os.path.basename(src)
-            tarfile = os.path.join(ROOT_PATH, f"{basename}.tar.gz")
-            subprocess.run(
-                f"tar zc -C {src} --exclude='logs' . > {tarfile}", shell=True, check=True,
-            )
-            cmd += f" --secret id={k},src={tarfile}"
+            cmd += ["--no-cache"]
+        else:
+            # Only looked up (and pulled) once the build is known to be needed
+            for image in get_cache_images(cache_from or [], pull_cache_from or []):
+                cmd += ["--cache-from", image]
+        if dependency_hash:
+            # Passed as a flag: the Dockerfile contents stay as generated
+            cmd += ["--label", f"brick.dependency_hash={dependency_hash}"]
+        # Embed cache metadata in the image so that it can later be used with --cache-from
+        cmd += ["--build-arg", "BUILDKIT_INLINE_CACHE=1"]
+        if secrets:
+            # Tar files are created outside of the workspace (so they never bloat the build context)
+            # and reused across builds of this invocation. They are removed on exit.
+            # Secrets are independent from each other: archive them concurrently
+            sources = [os.path.expanduser(v["src"]) for v in secrets.values()]
+            with ThreadPoolExecutor(max_workers=min(8, len(sources))) as executor:
+                tarfile_paths = list(executor.map(get_secret_tarfile, sources))
+            for k, tarfile_path in zip(secrets, tarfile_paths):
+                cmd += ["--secret", f"id={k},src={tarfile_path}"]
 
         with subprocess.Popen(
             args=cmd,
-            encoding="utf8",
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            shell=True,
             env=env,
-            universal_newlines=True,
+            bufsize=0,
             cwd=ROOT_PATH,
         ) as p:
-            logs = [cmd]
-            logger.debug(cmd)
+            logs = [" ".join(cmd)]
+            logger.debug(logs[0])
+            p.stdin.write(dockerfile_contents.encode("utf8"))  # type: ignore
+            p.stdin.close()  # type: ignore
 
             # State machine keeping track of step
             step_id = None
             step_command = None
             step_is_cacheable = None  # Some steps can't be cached
 
-            while p.poll() is None:
-                line = p.stdout.readline()  # type: ignore
-                if line != "":
-                    line = line.rstrip("\n")
-                    logs.append(line)
+            # Read until EOF (and not until the process exits) so that no output is lost
+            is_verbose = logger.isEnabledFor(logging.DEBUG)
+            for line in read_lines(p.stdout.fileno()):  # type: ignore
+                logs.append(line)
+                if is_verbose:
                     logger.debug(line)
 
-                    # A line is typically "#9 [3/6] COPY ...."
-                    # Followed by either
-                    # #9 CACHED
-                    # or
-                    # #9 DONE 0.0s
-
-                    # Detect step id
-                    step_id_match = re.match(r"#(?P<id>\d+)", line)
-                    if step_id_match:
-                        step_id = step_id_match.group("id")
-                    else:
-                        # Reset
-                        step_id = None
-                        step_command = None
-                        step_is_cacheable = None
-
-                    # Extra step extended info
-                    step_match = re.match(
-                        r"#(?P<id>\d+) \[.*(?P<number>\d+)/\d+\] (?P<command>.*)", line
-                    )
-                    if step_match:
-                        assert step_id == step_match.group("id")
-                        step_command = step_match.group("command")
-                        # Steps of the form "#X [ Y/Z] ..." can be cached
-                        # However, "FROM" commands can't
-                        step_is_cacheable = not step_command.startswith("FROM ")
-                    cache_invalidated_match = line.startswith(f"#{step_id} DONE")
-                    if (
-                        line.startswith(f"#{step_id}")
-                        and step_is_cacheable
-                        and cache_invalidated_match
-                        and is_cached
-                    ):
-                        # Cache has been invalidated
-                        logger.info(f"Cache invalidated by {step_command}")
-                        is_cached = False
+                # A line is typically "#9 [3/6] COPY ...."
+                # Followed by either
+                # #9 CACHED
+                # or
+                # #9 DONE 0.0s
+
+                # Detect step id
+                step_id_match = STEP_ID.match(line)
+                if step_id_match:
+                    step_id = step_id_match.group("id")
+                else:
+                    # Reset
+                    step_id = None
+                    step_command = None
+                    step_is_cacheable = None
+
+                # Extra step extended info
+                step_match = STEP_ID_AND_COMMAND.match(line) if step_id_match else None
+                if step_match:
+                    assert step_id == step_match.group("id")
+                    step_command = step_match.group("command")
+                    # Steps of the form "#X [ Y/Z] ..." can be cached
+                    # However, "FROM" commands can't
+                    step_is_cacheable = not step_command.startswith("FROM ")
+                cache_invalidated_match = line.startswith(f"#{step_id} DONE")
+                if (
+                    line.startswith(f"#{step_id}")
+                    and step_is_cacheable
+                    and cache_invalidated_match
+                    and is_cached
+                ):
+                    # Cache has been invalidated
+                    logger.info(f"Cache invalidated by {step_command}")
+                    is_cached = False
 
             returncode = p.wait()
             if returncode:
-                _out, err = p.communicate()
+                # stderr is redirected to stdout, so logs contain the error
                 logger.error("\n".join(logs))
-                logger.error(err)
                 logger.error(f"Failed building docker images for: {tags}")
                 sys.exit(returncode)
-            os.remove(dockerfile_path)
-    except (KeyboardInterrupt, SystemExit):
-        os.remove(dockerfile_path)
-        raise
-    finally:
-        # Cleanup tar files
-        for k, v in (secrets or {}).items():
-            src = os.path.expanduser(v["src"])
-            tarfile = os.path.join(ROOT_PATH, f"{basename}.tar.gz")
-            os.remove(tarfile)
 
-    with open(iidfile) as f:
-        digest = f.readline().split(":")[1].strip()
-    os.remove(iidfile)
+        with open(iidfile) as f:
+            digest = f.readline().split(":")[1].strip()
+    finally:
+        os.remove(iidfile)
 
     tag_image(image_name=digest, tags=tags)
 
     return tag_to_return, is_cached
 
 
+class ChunkStream(io.RawIOBase):
+    """
+    Read-only file object over an iterable of bytes chunks (e.g. an archive streamed by the
+    docker daemon), so that it can be consumed while it is downloaded
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def is_outside_of_folder(path: str) -> bool:
+    path = posixpath.normpath(path)
+    return posixpath.isabs(path) or path == ".." or path.startswith("../")
+
+
+def owned_by_current_user(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    # Same as `docker cp`: copied files belong to the user running brick,
+    # and symbolic links are copied verbatim (e.g. virtualenvs link to the system python)
+    for tarinfo in tar:
+        # Members must not be written outside of the destination folder
+        if posixpath.isabs(tarinfo.name) or ".." in tarinfo.name.split("/"):
+            raise Exception(f"Refusing to extract {tarinfo.name} outside of the destination folder")
+        # Hard links would make the extracted file share its contents with a host file
+        if tarinfo.islnk() and is_outside_of_folder(tarinfo.linkname):
+            raise Exception(
+                f"Refusing to extract {tarinfo.name} linking outside of the destination folder"
+            )
+        tarinfo.uid, tarinfo.gid = os.getuid(), os.getgid()
+        tarinfo.uname, tarinfo.gname = "", ""
+        yield tarinfo
+
+
+def docker_copy_from_image(image: str, paths: List[Tuple[str, str]]):
+    """
+    Copies (container path, host folder) pairs out of an image.
+    A single container is created, whatever the number of paths.
+    """
+    container = get_docker_client().containers.create(image)
+    try:
+        for container_path, host_folder in paths:
+            bits, _stat = container.get_archive(container_path)
+            # Streaming mode ("r|"): files are extracted as the archive is received
+            with tarfile.open(fileobj=ChunkStream(bits), mode="r|") as tar:
+                members = owned_by_current_user(tar)
+                if hasattr(tarfile, "tar_filter"):
+                    # Python versions shipping extraction filters also enforce their own checks
+                    # ("data" would refuse symbolic links pointing outside of host_folder)
+                    tar.extractall(host_folder, members=members, filter="tar")
+                else:
+                    tar.extractall(host_folder, members=members)
+    finally:
+        container.remove(v=True)
+
+
 def docker_images_list(name, last_tagged_before=None):
+    if last_tagged_before:
+        cutoff = arrow.get(last_tagged_before).to("utc")
+        # Docker reports UTC times as RFC 3339 strings ending in Z, which sort lexicographically
+        cutoff_iso = cutoff.format("YYYY-MM-DDTHH:mm:ss")
+
+        def is_tagged_before(last_tag_time):
+            if last_tag_time.endswith("Z"):
+                return last_tag_time[:19] < cutoff_iso
+            return arrow.get(last_tag_time) < cutoff
+
     return [
         {
             "id": x.attrs["Id"],
@@ -208,50 +477,62 @@ def docker_images_list(name, last_tagged_before=None):
             "size": x.attrs["Size"],
             "lastTagTime": x.attrs["Metadata"]["LastTagTime"],
         }
-        for x in docker_client.images.list(f"{name}_*")
-        if not last_tagged_before
-        or arrow.get(x.attrs["Metadata"]["LastTagTime"]) < arrow.get(last_tagged_before)
+        for x in get_docker_client().images.list(f"{name}_*")
+        if not last_tagged_before or is_tagged_before(x.attrs["Metadata"]["LastTagTime"])
     ]
 
 
 def get_image_names_with_dependency_hash(dependency_hash) -> List[str]:
-    images = (
-        subprocess.run(
-            f"docker images --filter \"label=brick.dependency_hash={dependency_hash}\" --format '{{{{.Repository}}}}:{{{{.Tag}}}}'",
-            shell=True,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        .stdout.decode("utf-8")
-        .strip()
-    )
-
-    return [s for s in images.split("\n") if s]
+    """
+    Images built by brick are all listed at once, rather than queried hash by hash.
+    The listing is then kept up to date as images are tagged.
+    """
+    # pylint: disable=global-statement
+    global _hashed_images
+    with _known_tags_lock:
+        if _hashed_images is None:
+            _hashed_images = {}
+            for image in get_docker_client().images.list(
+                filters={"label": "brick.dependency_hash"}
+            ):
+                _hashed_images.setdefault(image.labels["brick.dependency_hash"], []).extend(
+                    image.tags
+                )
+        return list(_hashed_images.get(dependency_hash, []))
+
+
+FROM_INSTRUCTION = re.compile(r"^FROM\s+(?P<image>\S+)", re.MULTILINE)
 
 
 def get_image_id_from_dockerfile_contents(dockerfile_contents: str) -> str:
-    from_image_names = [
-        l.split(" ")[1] for l in dockerfile_contents.split("\n") if l.startswith("FROM")
-    ]
-    if len(from_image_names) != 1:
+    # Generated Dockerfiles have a single stage
+    from_match = FROM_INSTRUCTION.search(dockerfile_contents)
+    if not from_match:
         raise Exception(f"Did not found a FROM statement in {dockerfile_contents}")
 
-    from_image_name = from_image_names[0]
+    from_image_name = from_match.group("image")
 
     def get_image_id() -> str:
-        image_id = docker_client.images.get(from_image_name).id
+        # Targets mostly share a few base images: resolve each of them once
+        with _known_tags_lock:
+            if from_image_name in _image_ids:
+                return _image_ids[from_image_name]
+        image_id = get_docker_client().images.get(from_image_name).id
         if not isinstance(image_id, str):
             raise Exception(f"Did not find string id on image {from_image_name}")
+        with _known_tags_lock:
+            _image_ids[from_image_name] = image_id
         return image_id
 
     try:
         return get_image_id()
     except docker.errors.ImageNotFound:
         logger.debug(f"Pulling down docker image {from_image_name}")
-        docker_client.images.pull(from_image_name)
+        pull_image(from_image_name)
         return get_image_id()
 
 
 def docker_image_delete(image_id, force=False):
-    docker_client.images.remove(image=image_id, noprune=False, force=force)
+    get_docker_client().images.remove(image=image_id, noprune=False, force=force)
+    # The tags of the deleted image are not known here
+    forget_known_tags()
@@ -1,14 +1,75 @@
+import functools
+import os
 import subprocess
+from typing import Optional
 
-# Git branch name with some replacement for making it Docker repository friendly
-GIT_BRANCH = subprocess.check_output(
-    "git rev-parse --abbrev-ref HEAD | " r"sed 's/\//\-/' | sed 's/ *//g'",
-    shell=True,
-    encoding="utf8",
-).rstrip("\n")
-
-MAIN_BRANCH = subprocess.check_output(
-    "git symbolic-ref refs/remotes/origin/HEAD | sed 's@^refs/remotes/origin/@@'",
-    shell=True,
-    encoding="utf8",
-).rstrip("\n")
+
+@functools.lru_cache(maxsize=1)
+def get_git_dir() -> Optional[str]:
+    """
+    .git folder of the repository containing the current folder, if it is a plain folder
+    (worktrees and submodules use a .git file, and are left to git itself)
+    """
+    path = os.getcwd()
+    while True:
+        git_path = os.path.join(path, ".git")
+        if os.path.exists(git_path):
+            return git_path if os.path.isdir(git_path) else None
+        parent_path = os.path.dirname(path)
+        if parent_path == path:
+            return None
+        path = parent_path
+
+
+def read_symbolic_ref(name: str, prefix: str) -> Optional[str]:
+    """
+    Reads a symbolic ref (e.g. HEAD) without spawning git, returning what follows prefix
+    """
+    git_dir = get_git_dir()
+    if not git_dir:
+        return None
+    try:
+        with open(os.path.join(git_dir, name)) as f:
+            ref = f.read().strip()
+    except OSError:
+        return None
+    if not ref.startswith(f"ref: {prefix}"):
+        # e.g. a detached HEAD
+        return None
+    return ref[len(f"ref: {prefix}") :]
+
+
+@functools.lru_cache(maxsize=1)
+def get_git_branch() -> str:
+    """
+    Git branch name with some replacement for making it Docker repository friendly.
+    Computed on first use only, as most commands never need it.
+    """
+    branch = read_symbolic_ref("HEAD", "refs/heads/")
+    if branch is None:
+        branch = subprocess.check_output(
+            ["git", "rev-parse", "--abbrev-ref", "HEAD"], encoding="utf8"
+        ).strip()
+    return branch.replace("/", "-").replace(" ", "").replace("#", "")
+
+
+@functools.lru_cache(maxsize=1)
+def get_main_branch() -> str:
+    """
+    Name of the default branch of the origin remote, or an empty string if it is not known
+    """
+    main_branch = read_symbolic_ref(
+        os.path.join("refs", "remotes", "origin", "HEAD"), "refs/remotes/origin/"
+    )
+    if main_branch is not None:
+        return main_branch
+    try:
+        ref = subprocess.check_output(
+            ["git", "symbolic-ref", "refs/remotes/origin/HEAD"],
+            encoding="utf8",
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except subprocess.CalledProcessError:
+        return ""
+    prefix = "refs/remotes/origin/"
+    return ref[len(prefix) :] if ref.startswith(prefix) else ref
@@ -1,42 +1,131 @@
+import copy
+import functools
 import glob
+import hashlib
+import json
 import os
-from typing import List
+from typing import Iterator, List, Optional, Set, Tuple
 import re
+import stat
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 from braceexpand import braceexpand
 
 from .logger import logger
-from .shell import get_sha1_command, run_shell_command
+
+try:
+    # libyaml bindings are several times faster than the pure Python loader
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader  # type: ignore
+
+
+@functools.lru_cache(maxsize=None)
+def discover_root_path(cwd: str) -> str:
+    """
+    Returns the closest parent folder of cwd containing a WORKSPACE file
+    """
+    path = os.path.abspath(cwd)
+    while not os.path.exists(os.path.join(path, "WORKSPACE")):
+        parent_path = os.path.dirname(path)
+        if parent_path == path:
+            raise Exception("No WORKSPACE found. Did you launch brick from the right project?")
+        path = parent_path
+    return path
+
+
+def get_root_path() -> str:
+    # BRICK_ROOT_PATH skips the discovery (e.g. for scripts running from deep folders)
+    root_path = os.environ.get("BRICK_ROOT_PATH")
+    if root_path:
+        if not os.path.exists(os.path.join(root_path, "WORKSPACE")):
+            raise Exception(f"No WORKSPACE found in BRICK_ROOT_PATH ({root_path})")
+        return os.path.abspath(root_path)
+    return discover_root_path(os.getcwd())
 
 
 # Discover root path
-ROOT_PATH = os.getcwd()
-i = 0
-while not os.path.exists(os.path.join(ROOT_PATH, "WORKSPACE")):
-    if i > 10:
-        raise Exception("Maximum recursion reached. Did you launch brick from the right project?")
-    ROOT_PATH = os.path.abspath(os.path.join(ROOT_PATH, os.pardir))
-    i += 1
+ROOT_PATH = get_root_path()
+
+
+# Characters that make an input a glob pattern (braces are expanded beforehand)
+GLOB_CHARACTERS = frozenset("*?[")
+
+
+@functools.lru_cache(maxsize=512)
+def _braceexpand(pattern: str) -> Tuple[str, ...]:
+    return tuple(braceexpand(pattern))
+
+
+def expand_braces(patterns) -> List[str]:
+    """
+    Bash-style brace expansion of all patterns, without duplicates.
+    Targets often share patterns, so each one is only expanded once.
+    """
+    return list(dict.fromkeys(x for pattern in patterns for x in _braceexpand(pattern)))
+
+
+def expand_inputs(target, inputs) -> List[str]:
+    # Callers may extend the returned list: give them their own copy
+    return list(_expand_inputs(target, tuple(inputs)))
+
+
+def clear_expanded_inputs():
+    """
+    Must be called when files are added to the workspace (e.g. the outputs of a build),
+    as globs could now match them
+    """
+    _expand_inputs.cache_clear()
 
 
-def expand_inputs(target, inputs):
+@functools.lru_cache(maxsize=None)
+def _expand_inputs(target: str, inputs: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Inputs are expanded once per invocation, even though build invokes prepare,
+    test invokes build, ..
+    """
     ret = []
-    for input_path in inputs:
-        # Also do bash-style brace expansions before globbing
-        for input_path in braceexpand(input_path):
-            matches = glob.glob(os.path.join(ROOT_PATH, target, input_path), recursive=True)
-            if not matches:
-                logger.debug(
-                    f"Could not find an match for {os.path.join(ROOT_PATH, target, input_path)}"
-                )
-                raise Exception(f"No matches found for input {input_path} for target {target}")
-            for g in matches:
-                # Paths should be relative to root
-                p = os.path.relpath(g, start=ROOT_PATH)
-                ret.append(p)
-    return ret
+    root_prefix = os.path.join(ROOT_PATH, "")
+    # Also do bash-style brace expansions before globbing
+    for input_path in expand_braces(inputs):
+        # Normalized upfront, so that matches can simply be sliced to be relative to root
+        full_path = os.path.normpath(os.path.join(ROOT_PATH, target, input_path))
+        if GLOB_CHARACTERS.isdisjoint(input_path):
+            # Most inputs are plain paths, which only need an existence check
+            matches = [full_path] if os.path.lexists(full_path) else []
+        else:
+            matches = glob.glob(full_path, recursive=True)
+        if not matches:
+            logger.debug(f"Could not find an match for {full_path}")
+            raise Exception(f"No matches found for input {input_path} for target {target}")
+        for g in matches:
+            # Paths should be relative to root
+            if g.startswith(root_prefix):
+                ret.append(g[len(root_prefix) :])
+            else:
+                ret.append(os.path.relpath(g, start=ROOT_PATH))
+    # Glob results follow directory listing order, which differs between machines.
+    # Sorting keeps the generated COPY instructions (and thus the layer cache) stable.
+    return tuple(sorted(set(ret)))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_build_outputs(dir_path: str) -> Optional[Tuple[str, ...]]:
+    """
+    Absolute paths of the build outputs of the BUILD.yaml in dir_path, if any.
+    Targets share most of their parent folders, so each folder is only looked up once.
+    """
+    build_path = os.path.join(dir_path, "BUILD.yaml")
+    if not os.path.exists(build_path):
+        return None
+    config = _load_build_config(build_path, expand_variables=False)
+    return tuple(
+        os.path.abspath(os.path.join(dir_path, x))
+        for x in config["steps"].get("build", {}).get("outputs", [])
+    )
 
 
 def intersecting_outputs(target, inputs):
@@ -47,53 +136,97 @@ def intersecting_outputs(target, inputs):
     used to build it.
     """
     matches = set()
+    target_path = os.path.abspath(os.path.join(ROOT_PATH, target))
+    root_prefix = os.path.join(ROOT_PATH, "")
     for input_path in inputs:
         # Also do bash-style brace expansions before globbing
-        for input_path in braceexpand(input_path):
+        for input_path in _braceexpand(input_path):
             # Make relative to cwd
             input_path = os.path.abspath(os.path.join(ROOT_PATH, target, input_path))
             # Search for a BUILD.yaml
             dir_path = input_path if os.path.isdir(input_path) else os.path.dirname(input_path)
             # Check if input is a descendant of WORKSPACE
             # else there's no point searching
-            if ROOT_PATH in dir_path:
+            if dir_path == ROOT_PATH or dir_path.startswith(root_prefix):
                 while True:
                     # Test if we have reached the current target
-                    if os.path.abspath(os.path.join(ROOT_PATH, target)) == dir_path:
+                    if target_path == dir_path:
                         break
                     # Test if dir_path has a BUILD.yaml
-                    build_path = os.path.join(dir_path, "BUILD.yaml")
-                    if os.path.exists(build_path):
-                        # Open yaml and check if output matches
-                        with open(build_path) as f:
-                            config = yaml.load(f, Loader=yaml.FullLoader)
-                            outputs = [
-                                os.path.abspath(os.path.join(dir_path, x))
-                                for x in config["steps"].get("build", {}).get("outputs", [])
-                            ]
-                            # Test if any output is a descendant of input (thus a dependency)
-                            # or if input is a descendant of any output (also a dependency)
-                            if any(
-                                [
-                                    output.startswith(input_path) or input_path.startswith(output)
-                                    for output in outputs
-                                ]
-                            ):
-                                matches.add(os.path.relpath(dir_path, ROOT_PATH))
+                    outputs = _get_build_outputs(dir_path)
+                    if outputs is not None:
+                        # Test if any output is a descendant of input (thus a dependency)
+                        # or if input is a descendant of any output (also a dependency)
+                        if any(
+                            output.startswith(input_path) or input_path.startswith(output)
+                            for output in outputs
+                        ):
+                            matches.add(os.path.relpath(dir_path, ROOT_PATH))
                         break
                     else:
                         # This will move one level up (see assumption in docstring)
                         dir_path = os.path.dirname(dir_path)
-                        if os.path.abspath(dir_path) in [ROOT_PATH, "/"]:
+                        # dir_path is already normalized
+                        if dir_path in (ROOT_PATH, "/"):
                             # Abort, found nothing
                             break
     return sorted(matches)
 
 
+def _compute_stat_fingerprint(paths: List[str]) -> str:
+    """
+    Compute a cheap fingerprint of all files contained in the relative paths,
+    based on their metadata (and not their contents)
+    """
+    fingerprint = hashlib.sha1()
+    for path in paths:
+        full_path = os.path.join(ROOT_PATH, path)
+        file_paths = [full_path] if not os.path.isdir(full_path) else []
+        for dir_path, _dir_names, file_names in os.walk(full_path):
+            file_paths += [os.path.join(dir_path, x) for x in file_names]
+        for file_path in file_paths:
+            st = os.lstat(file_path)
+            metadata = f"{file_path}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}"
+            fingerprint.update(metadata.encode("utf8"))
+    return fingerprint.hexdigest()
+
+
+def _find_files(paths: List[str]) -> Iterator[str]:
+    """
+    Regular files contained in the relative paths, without following symlinks
+    """
+    for path in paths:
+        try:
+            st = os.lstat(os.path.join(ROOT_PATH, path))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            yield path
+        elif stat.S_ISDIR(st.st_mode):
+            full_path = os.path.join(ROOT_PATH, path).rstrip("/")
+            for dir_path, _dir_names, file_names in os.walk(full_path):
+                # Paths are reported the way find does: relative to the given path
+                rel_dir_path = path.rstrip("/") + dir_path[len(full_path) :]
+                for x in file_names:
+                    if stat.S_ISREG(os.lstat(os.path.join(dir_path, x)).st_mode):
+                        yield f"{rel_dir_path}/{x}"
+
+
+def _compute_file_hash(path: str) -> str:
+    # hashlib releases the GIL on large buffers: files are hashed in parallel
+    sha1 = hashlib.sha1()
+    with open(os.path.join(ROOT_PATH, path), "rb") as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def compute_hash_from_paths(paths: List[str]) -> str:
     """
     Compute a single hash for all files contained in the relative paths
     Inspiration: https://stackoverflow.com/a/545413
+    Hashes are cached by file metadata, so that unchanged inputs are not read again
+    (unused entries are evicted like other cache files)
     """
     if not paths:
         raise ValueError("Expected input paths")
@@ -101,17 +234,33 @@ def compute_hash_from_paths(paths: List[str]) -> str:
     if not isinstance(paths, list):
         raise ValueError(f"Expected input paths as a list, got {type(paths)}")
 
+    cache_path = None
+    try:
+        cache_path = get_cache_path("hashes", _compute_stat_fingerprint(paths))
+        return _read_cache_file(cache_path)
+    except OSError:
+        pass
+
     t_start = time.time()
-    sha1_command = get_sha1_command()
-    cmd = f"find {' '.join(paths)} -type f -print0 | sort -z | xargs -0 {sha1_command} | {sha1_command}"
-    sha1_sum: str = run_shell_command(cmd=cmd, cwd=ROOT_PATH).split(" ")[0].strip()
-    assert len(sha1_sum) == 40, "expected sha1sum of length 40"
+    # Same result as `find {paths} -type f -print0 | sort -z | xargs -0 sha1sum | sha1sum`
+    # run with LC_ALL=C: files are sorted bytewise whatever the locale, and names containing
+    # a backslash or a newline are not escaped like sha1sum does
+    file_paths = sorted(_find_files(paths), key=os.fsencode)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as executor:
+        file_hashes = executor.map(_compute_file_hash, file_paths)
+        sha1 = hashlib.sha1()
+        for file_path, file_hash in zip(file_paths, file_hashes):
+            sha1.update(f"{file_hash}  {file_path}\n".encode("utf8", errors="surrogateescape"))
+    sha1_sum = sha1.hexdigest()
 
     # Wasting more than a few seconds hashing usually means that the input dependencies
     # should be tweaked.
     hashing_time = time.time() - t_start
     if hashing_time > 3:
-        logger.info(f'😴 Observed slow hashing ({hashing_time:.1f}s) for command "{cmd}"')
+        logger.info(f"😴 Observed slow hashing ({hashing_time:.1f}s) for inputs {paths}")
+
+    if cache_path:
+        _write_cache_file(cache_path, sha1_sum)
 
     return sha1_sum
 
@@ -124,23 +273,29 @@ def get_relative_config_path(target):
     return os.path.relpath(get_config_path(target), start=ROOT_PATH)
 
 
+BRICK_ENVIRONMENT_VARIABLE = re.compile(
+    r"[$]{(?P<key>BRICK_[A-Z\d_]*)(?:[:]-(?P<default>[A-z\.\d-]*))?}"
+)
+
+
 def expand_brick_environment_variables(before_expansion: str) -> str:
     """
     Expands any environment variable that starts with BRICK_.
     Support syntax: ${BRICK_FOO} and ${BRICK_FOO:-default}
     """
+    if "BRICK_" not in before_expansion:
+        # Most configurations have no variables: skip the regex
+        return before_expansion
 
     def replacer(match):
         groups = match.groupdict()
         key = groups["key"]
         default_value = groups["default"]
-        replacement = os.getenv(key, default_value)
+        replacement = os.environ.get(key, default_value)
         assert replacement, f"Did not find environment variable {key} or default value"
         return replacement
 
-    pattern = re.compile(r"[$]{(?P<key>BRICK_[A-Z\d_]*)(?:[:]-(?P<default>[A-z\.\d-]*))?}")
-
-    after_expansion = pattern.sub(replacer, before_expansion)
+    after_expansion = BRICK_ENVIRONMENT_VARIABLE.sub(replacer, before_expansion)
 
     assert (
         "BRICK_" not in after_expansion
@@ -149,13 +304,123 @@ def expand_brick_environment_variables(before_expansion: str) -> str:
     return after_expansion
 
 
+def get_cache_path(*paths: str) -> str:
+    """
+    Returns a path inside the brick cache folder.
+    The folder lives outside of the workspace so that cache files never end up
+    in the dependency hash of a target.
+    """
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "brick", *paths)
+
+
+# Cache files that were not used for that long are removed (see _evict_cache_files)
+CACHE_MAX_AGE = 30 * 24 * 3600
+_evicted_cache_folders: Set[str] = set()
+
+
+def _read_cache_file(cache_path: str) -> str:
+    with open(cache_path) as f:
+        contents = f.read()
+    try:
+        # The modification time tells the eviction when the file was last used
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return contents
+
+
+def _write_cache_file(cache_path: str, contents: str):
+    # Write atomically so that concurrent brick invocations never read a partial file
+    cache_folder = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_folder)
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug(f"Could not write cache file {cache_path}: {e}")
+        return
+
+    # New entries are only written on cache misses, which is when stale ones pile up
+    if cache_folder not in _evicted_cache_folders:
+        _evicted_cache_folders.add(cache_folder)
+        _evict_cache_files(cache_folder)
+
+
+def _evict_cache_files(cache_folder: str):
+    """
+    Removes the files of a cache folder that were not used for CACHE_MAX_AGE seconds
+    """
+    expiry_time = time.time() - CACHE_MAX_AGE
+    try:
+        with os.scandir(cache_folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < expiry_time:
+                        os.remove(entry.path)
+                except OSError:
+                    # Removed by a concurrent brick invocation
+                    pass
+    except OSError as e:
+        logger.debug(f"Could not evict cache files from {cache_folder}: {e}")
+
+
+@functools.lru_cache(maxsize=128)
+def _read_build_config(path: str, mtime_ns: int) -> str:
+    # mtime_ns is only part of the cache key, so that edited files are read again
+    with open(path) as f:
+        return f.read()
+
+
+def _load_build_config(path: str, expand_variables: bool = True):
+    """
+    Loads a BUILD.yaml file.
+    The same files are loaded many times per run (build invokes prepare, test invokes build, ..),
+    so both reading and parsing are cached for the lifetime of the process.
+    """
+    path = os.path.abspath(path)
+    contents = _read_build_config(path, os.stat(path).st_mtime_ns)
+    if expand_variables:
+        contents = expand_brick_environment_variables(contents)
+    # The parsed configuration is shared by all callers, so each one gets its own copy
+    return copy.deepcopy(_parse_build_config(contents))
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_build_config(contents: str):
+    """
+    Parsing YAML is slow, so a JSON copy of the parsed configuration is kept in the cache folder,
+    keyed by the hash of the file contents.
+    """
+    key = hashlib.sha1(contents.encode("utf8")).hexdigest()
+    cache_path = get_cache_path("configs", f"{key}.json")
+    try:
+        return json.loads(_read_cache_file(cache_path))
+    except (OSError, ValueError):
+        pass
+
+    config = yaml.load(contents, Loader=YamlLoader)
+
+    try:
+        serialized_config = json.dumps(config)
+    except TypeError:
+        # Not representable in JSON (e.g. dates)
+        return config
+    if json.loads(serialized_config) != config:
+        # JSON would alter the configuration (e.g. integer keys)
+        return config
+
+    _write_cache_file(cache_path, serialized_config)
+
+    return config
+
+
 def get_config(target):
     try:
-        with open(get_config_path(target)) as f:
-            # TODO: we could be basic sanity checking here of the configuration
-            raw_config = f.read()
-            expanded_config = expand_brick_environment_variables(raw_config)
-            return yaml.load(expanded_config, Loader=yaml.FullLoader)
+        # TODO: we could be basic sanity checking here of the configuration
+        return _load_build_config(get_config_path(target))
     except FileNotFoundError:
         raise Exception(f"BUILD.yaml not found.")
 
@@ -24,7 +24,6 @@ setuptools.setup(
         "docker==3.7.0",
         "typing-extensions==3.7.4.3",
         "yamllint==1.17.0",
-        "wcmatch==6.0.1",
     ],
     extras_require={
         "dev": [
@@ -33,6 +32,7 @@ setuptools.setup(
             "pylint==2.6.0",
             "pytest==6.0.1",
             "pytest-cov==2.10.1",
+            "pytest-xdist==2.1.0",
         ]
     },
 )
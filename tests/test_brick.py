@@ -5,7 +5,7 @@ As a minimum we want to test:
 """
 
 from collections import defaultdict, namedtuple
-from typing import Any, Dict, List, Tuple, Set
+from typing import Any, Dict, Iterator, List, Tuple, Set
 import importlib
 import logging
 import os
@@ -13,41 +13,69 @@ import subprocess
 
 from click.testing import CliRunner, Result
 from click.core import Context
+import pytest
 
 from brick.logger import logger, handler
 from brick import git
 
+# Only the first path needs to be made absolute (and normalized): the others derive from it
 CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
-EXAMPLES_FOLDER = os.path.abspath(os.path.join(CURRENT_FOLDER, "../examples"))
-EXAMPLE_NODE_FOLDER = os.path.abspath(os.path.join(EXAMPLES_FOLDER, "brick_example_node"))
-EXAMPLE_PYTHON_FOLDER = os.path.abspath(os.path.join(EXAMPLES_FOLDER, "brick_example_python"))
+EXAMPLES_FOLDER = os.path.join(os.path.dirname(CURRENT_FOLDER), "examples")
+EXAMPLE_NODE_FOLDER = os.path.join(EXAMPLES_FOLDER, "brick_example_node")
+EXAMPLE_PYTHON_FOLDER = os.path.join(EXAMPLES_FOLDER, "brick_example_python")
 
-OUTPUT_FILE_NODE = os.path.abspath(os.path.join(EXAMPLE_NODE_FOLDER, "dist/out.txt"))
-OUTPUT_FILE_PYTHON = os.path.abspath(os.path.join(EXAMPLE_PYTHON_FOLDER, "dist/out.txt"))
+OUTPUT_FILE_NODE = os.path.join(EXAMPLE_NODE_FOLDER, "dist", "out.txt")
+OUTPUT_FILE_PYTHON = os.path.join(EXAMPLE_PYTHON_FOLDER, "dist", "out.txt")
 
 logger.removeHandler(handler)
 
 DockerImage = namedtuple("DockerImage", ["tag", "created_at"])
 
 
-def run_shell_command(cmd: str, check=True):
+def is_docker_available() -> bool:
+    try:
+        return (
+            subprocess.run(
+                ["docker", "info"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=30,
+                check=False,
+            ).returncode
+            == 0
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+# The daemon is checked once, instead of each test failing (or hanging) on its own
+pytestmark = pytest.mark.skipif(not is_docker_available(), reason="docker is not available")
+
+
+def run_docker_command(*args: str, check=True):
     return subprocess.run(
-        cmd, shell=True, check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        ["docker", *args],
+        check=check,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
     )
 
 
 def get_docker_images() -> Tuple[Set[str], Dict[str, List[DockerImage]]]:
-    result = run_shell_command(
-        f'docker images --format "{{{{.Repository}}}};{{{{.Tag}}}};{{{{.CreatedAt}}}}" | grep "brick_example"',
+    # Filtered by the docker daemon: no shell nor grep involved
+    result = run_docker_command(
+        "images",
+        "--filter=reference=brick_example*",
+        "--format",
+        "{{.Repository}};{{.Tag}};{{.CreatedAt}}",
     )
 
-    lines = result.stdout.decode("utf-8").split("\n")
     repositories_to_images = defaultdict(list)
     images = set([])
-    for line in lines:
-        if line == "":
-            continue
-        (repository, tag, createdAt) = line.split(";")
+    for line in result.stdout.splitlines():
+        repository, _, rest = line.partition(";")
+        tag, _, createdAt = rest.partition(";")
         repositories_to_images[repository].append(DockerImage(tag, createdAt))
         images.add(f"{repository}:{tag}")
 
@@ -63,25 +91,36 @@ def get_output_file_content(file_path: str):
 
 
 def clean_up_test_images() -> None:
-    run_shell_command(
-        "docker images -a | grep 'brick_example' | awk '{print $3}' | xargs docker rmi -f",
-        check=False,
-    )
+    image_ids = run_docker_command(
+        "images", "-a", "-q", "--filter=reference=brick_example*"
+    ).stdout.split()
+    if image_ids:
+        # The same image can be listed once per tag
+        run_docker_command("rmi", "-f", *sorted(set(image_ids)), check=False)
 
 
 def clean_up_output_folders() -> None:
     for path in [OUTPUT_FILE_NODE, OUTPUT_FILE_PYTHON]:
-        if os.path.isfile(path):
+        try:
             os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
-def invoke_brick_command(monkeypatch, command: str, folder: str, recursive=False) -> Result:
-    # pylint: disable import-outside-toplevel
-
+def invoke_brick_command(command: str, folder: str, recursive=False) -> Result:
     if recursive:
         assert folder == EXAMPLES_FOLDER
 
-    monkeypatch.chdir(folder)
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        return run_brick_command(command, recursive)
+    finally:
+        os.chdir(cwd)
+
+
+def run_brick_command(command: str, recursive: bool) -> Result:
+    # pylint: disable import-outside-toplevel
 
     # The funky import order and module reloading is due to the monkey patching
     # and the nature of the code running when the modules are imported.
@@ -94,6 +133,11 @@ def invoke_brick_command(monkeypatch, command: str, folder: str, recursive=False
 
     importlib.reload(__main__)
 
+    # Images are added and removed outside of brick between invocations
+    from brick import dockerlib
+
+    dockerlib.forget_known_tags()
+
     commands = {
         "build": __main__.build,
         "deploy": __main__.deploy,
@@ -123,18 +167,52 @@ def get_log_messages(caplog: Any, log_level: int) -> List[str]:
 
 
 def get_docker_images_built_from_debug_logs(debug_logs: List[str]) -> Set[str]:
-    return {l.split(" ")[-1] for l in debug_logs if "Tagging" in l}
+    return {l.rpartition(" ")[2] for l in debug_logs if "Tagging" in l}
 
 
-def test_examples_node_build_1_on_master(monkeypatch, caplog) -> None:
+class RecordsHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__(level=logging.DEBUG)
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+@pytest.fixture(scope="module")
+def on_master() -> Iterator[None]:
+    """
+    Builds run as if on the master branch, for all the tests of the module requesting it
+    """
+    get_git_branch = git.get_git_branch
+    git.get_git_branch = lambda: "master"
+    try:
+        yield
+    finally:
+        git.get_git_branch = get_git_branch
+
+
+@pytest.fixture(scope="module")
+def node_built_on_master(on_master) -> List[str]:
+    """
+    Builds the node example on master from a clean state, once for all the tests relying on it.
+    Returns the debug logs of that build.
+    """
     clean_up_test_images()
     clean_up_output_folders()
 
-    monkeypatch.setattr(git, "GIT_BRANCH", "master")
+    records_handler = RecordsHandler()
+    logger.addHandler(records_handler)
+    try:
+        invoke_brick_command(command="build", folder=EXAMPLE_NODE_FOLDER)
+    finally:
+        logger.removeHandler(records_handler)
 
-    invoke_brick_command(monkeypatch, command="build", folder=EXAMPLE_NODE_FOLDER)
+    return [r.getMessage() for r in records_handler.records]
 
-    debug_logs = get_log_messages(caplog, logging.DEBUG)
+
+def test_examples_node_build_1_on_master(node_built_on_master) -> None:
+    debug_logs = node_built_on_master
 
     expected_docker_images_built = {
         "brick_example_node_prepare:latest",
@@ -155,11 +233,8 @@ def test_examples_node_build_1_on_master(monkeypatch, caplog) -> None:
     assert get_output_file_content(OUTPUT_FILE_NODE) == "hello from node.js"
 
 
-def test_examples_node_build_2_on_master(caplog, monkeypatch) -> None:
-    # NOTE: test depends on test_examples_node_build_1_on_master
-    monkeypatch.setattr(git, "GIT_BRANCH", "master")
-
-    invoke_brick_command(monkeypatch, command="build", folder=EXAMPLE_NODE_FOLDER)
+def test_examples_node_build_2_on_master(node_built_on_master, caplog) -> None:
+    invoke_brick_command(command="build", folder=EXAMPLE_NODE_FOLDER)
 
     debug_logs = get_log_messages(caplog, logging.DEBUG)
 
@@ -176,13 +251,12 @@ def test_examples_node_build_2_on_master(caplog, monkeypatch) -> None:
     assert get_docker_images_built_from_debug_logs(debug_logs) == set([])  # nothing was built
 
 
-def test_examples_node_build_3_on_feature_branch(caplog, monkeypatch) -> None:
-    # NOTE: test depends on test_examples_node_build_1_on_master
+def test_examples_node_build_3_on_feature_branch(node_built_on_master, caplog, monkeypatch) -> None:
     clean_up_output_folders()
 
-    monkeypatch.setattr(git, "GIT_BRANCH", "some_branch")
+    monkeypatch.setattr(git, "get_git_branch", lambda: "some_branch")
 
-    invoke_brick_command(monkeypatch, command="build", folder=EXAMPLE_NODE_FOLDER)
+    invoke_brick_command(command="build", folder=EXAMPLE_NODE_FOLDER)
 
     debug_logs = get_log_messages(caplog, logging.DEBUG)
 
@@ -199,8 +273,9 @@ def test_examples_node_build_3_on_feature_branch(caplog, monkeypatch) -> None:
         "brick_example_node_prepare:master",
     }
 
-    assert get_docker_images()[0] == expected_docker_images_built.union(
-        docker_images_built_in_previous_tests
+    assert (
+        get_docker_images()[0]
+        == expected_docker_images_built | docker_images_built_in_previous_tests
     )
 
     assert (
@@ -222,15 +297,13 @@ def test_examples_node_build_3_on_feature_branch(caplog, monkeypatch) -> None:
     assert get_output_file_content(OUTPUT_FILE_NODE) == "hello from node.js"
 
 
-def test_workspace_build(monkeypatch, caplog) -> None:
+def test_workspace_build(on_master, caplog) -> None:
     clean_up_test_images()
     clean_up_output_folders()
 
     assert get_output_file_content(OUTPUT_FILE_PYTHON) is None
 
-    monkeypatch.setattr(git, "GIT_BRANCH", "master")
-
-    invoke_brick_command(monkeypatch, command="build", folder=EXAMPLES_FOLDER, recursive=True)
+    invoke_brick_command(command="build", folder=EXAMPLES_FOLDER, recursive=True)
 
     debug_logs = get_log_messages(caplog, logging.DEBUG)
 
@@ -255,10 +328,8 @@ def test_workspace_build(monkeypatch, caplog) -> None:
     assert get_output_file_content(OUTPUT_FILE_PYTHON) == "hello from node.js and Python"
 
 
-def test_workspace_test(monkeypatch, caplog) -> None:
-    monkeypatch.setattr(git, "GIT_BRANCH", "master")
-
-    invoke_brick_command(monkeypatch, command="test", folder=EXAMPLES_FOLDER, recursive=True)
+def test_workspace_test(on_master, caplog) -> None:
+    invoke_brick_command(command="test", folder=EXAMPLES_FOLDER, recursive=True)
 
     debug_logs = get_log_messages(caplog, logging.DEBUG)
 
@@ -0,0 +1,52 @@
+import io
+import tarfile
+
+import pytest
+
+from brick.dockerlib import owned_by_current_user
+
+
+def make_tarfile(*members: tarfile.TarInfo) -> tarfile.TarFile:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for member in members:
+            tar.addfile(member)
+    buffer.seek(0)
+    return tarfile.open(fileobj=buffer, mode="r")
+
+
+def make_link(name: str, linkname: str, type=tarfile.SYMTYPE) -> tarfile.TarInfo:
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type, tarinfo.linkname = type, linkname
+    return tarinfo
+
+
+def test_owned_by_current_user():
+    tar = make_tarfile(
+        tarfile.TarInfo("dist/index.js"),
+        make_link("dist/latest.js", "index.js"),
+        make_link("dist/lib/main.js", "../index.js"),
+        make_link("dist/copy.js", "dist/index.js", type=tarfile.LNKTYPE),
+        # Symbolic links are copied verbatim, wherever they point to
+        make_link("dist/venv/bin/python", "/usr/local/bin/python3"),
+        make_link("dist/node_modules/.bin/tsc", "../../../node_modules/typescript/bin/tsc"),
+    )
+    assert [tarinfo.name for tarinfo in owned_by_current_user(tar)] == [
+        "dist/index.js",
+        "dist/latest.js",
+        "dist/lib/main.js",
+        "dist/copy.js",
+        "dist/venv/bin/python",
+        "dist/node_modules/.bin/tsc",
+    ]
+
+    # Members can't escape the destination folder
+    for tarinfo in [
+        tarfile.TarInfo("/etc/passwd"),
+        tarfile.TarInfo("dist/../../passwd"),
+        make_link("dist/passwd", "../etc/passwd", type=tarfile.LNKTYPE),
+        make_link("dist/passwd", "/etc/passwd", type=tarfile.LNKTYPE),
+    ]:
+        with pytest.raises(Exception) as excinfo:
+            list(owned_by_current_user(make_tarfile(tarinfo)))
+        assert "Refusing to extract" in str(excinfo.value)
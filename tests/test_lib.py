@@ -1,6 +1,16 @@
+import os
+
 import pytest
 
-from brick.lib import expand_brick_environment_variables, get_build_repository_and_tag
+from brick import lib
+from brick.lib import (
+    compute_hash_from_paths,
+    expand_brick_environment_variables,
+    expand_inputs,
+    get_build_repository_and_tag,
+    get_cache_path,
+    get_config,
+)
 
 
 def test_expand_brick_environment_variables(monkeypatch):
@@ -49,3 +59,114 @@ def test_get_build_repository_and_tag():
     assert get_build_repository_and_tag({"build": {}}) is None
     assert get_build_repository_and_tag({"build": {"tag": "foo:bar"}}) == ["foo", "bar"]
     assert get_build_repository_and_tag({"build": {"tag": "foo"}}) == ["foo", "latest"]
+
+
+def test_get_config_is_cached(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    with open(tmp_path / "BUILD.yaml", "w") as f:
+        f.write("name: foo\nsteps:\n  build:\n    image: ${BRICK_IMAGE:-python}\n")
+
+    expected_config = {"name": "foo", "steps": {"build": {"image": "python"}}}
+    assert get_config(str(tmp_path)) == expected_config
+    assert len(os.listdir(get_cache_path("configs"))) == 1
+
+    # Second load goes through the cache
+    assert get_config(str(tmp_path)) == expected_config
+    assert len(os.listdir(get_cache_path("configs"))) == 1
+
+    # Expanded variables are part of the cache key
+    monkeypatch.setenv("BRICK_IMAGE", "node")
+    assert get_config(str(tmp_path))["steps"]["build"]["image"] == "node"
+    assert len(os.listdir(get_cache_path("configs"))) == 2
+
+    # Callers can't alter the cached configuration
+    get_config(str(tmp_path))["steps"]["build"]["image"] = "ruby"
+    assert get_config(str(tmp_path))["steps"]["build"]["image"] == "node"
+
+
+def test_stale_cache_files_are_evicted(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    os.makedirs(get_cache_path("configs"))
+    stale_path = get_cache_path("configs", "stale.json")
+    used_path = get_cache_path("configs", "used.json")
+    for path in [stale_path, used_path]:
+        with open(path, "w") as f:
+            f.write("{}")
+        os.utime(path, (0, 0))
+    # Reading a cache file marks it as used
+    assert lib._read_cache_file(used_path) == "{}"
+
+    with open(tmp_path / "BUILD.yaml", "w") as f:
+        f.write("name: foo\n")
+    get_config(str(tmp_path))
+    cache_files = os.listdir(get_cache_path("configs"))
+    assert "stale.json" not in cache_files
+    assert "used.json" in cache_files
+    assert len(cache_files) == 2
+
+
+def test_expand_inputs():
+    # Paths are relative to the WORKSPACE (the tests folder)
+    assert expand_inputs(".", ["conftest.py"]) == ["conftest.py"]
+    # Results are sorted and deduplicated
+    assert expand_inputs(".", ["test_lib.py", "{conftest.py,WORKSPACE}", "test_lib.py"]) == [
+        "WORKSPACE",
+        "conftest.py",
+        "test_lib.py",
+    ]
+    assert "test_lib.py" in expand_inputs(".", ["test_*.py"])
+
+    # Results are memoized, but callers get their own list
+    inputs = expand_inputs(".", ["conftest.py"])
+    inputs.append("WORKSPACE")
+    assert expand_inputs(".", ["conftest.py"]) == ["conftest.py"]
+
+    with pytest.raises(Exception) as excinfo:
+        expand_inputs(".", ["missing.py"])
+    assert "No matches found for input missing.py" in str(excinfo.value)
+
+
+def test_compute_hash_from_paths_is_cached(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(lib, "ROOT_PATH", str(tmp_path))
+    os.makedirs(tmp_path / "src")
+    with open(tmp_path / "src" / "foo.py", "w") as f:
+        f.write("foo")
+
+    sha1_sum = compute_hash_from_paths(["src"])
+    assert len(os.listdir(get_cache_path("hashes"))) == 1
+    assert compute_hash_from_paths(["src"]) == sha1_sum
+    assert len(os.listdir(get_cache_path("hashes"))) == 1
+
+    # Modified files are hashed again
+    with open(tmp_path / "src" / "foo.py", "w") as f:
+        f.write("bar")
+    assert compute_hash_from_paths(["src"]) != sha1_sum
+    assert len(os.listdir(get_cache_path("hashes"))) == 2
+
+    # Entries of outdated inputs are evicted once unused for long enough
+    for file_name in os.listdir(get_cache_path("hashes")):
+        os.utime(get_cache_path("hashes", file_name), (0, 0))
+    lib._evicted_cache_folders.clear()
+    with open(tmp_path / "src" / "foo.py", "w") as f:
+        f.write("baz")
+    compute_hash_from_paths(["src"])
+    assert len(os.listdir(get_cache_path("hashes"))) == 1
+
+
+def test_compute_hash_from_paths(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(lib, "ROOT_PATH", str(tmp_path / "workspace"))
+    for path, contents in [
+        ("src/foo.py", "foo"),
+        ("src/sub/bar.txt", "bar\n"),
+        ("src/B/empty", ""),
+        ("src/a-b.py", "x"),
+        ("top.txt", "y"),
+    ]:
+        os.makedirs(os.path.dirname(tmp_path / "workspace" / path), exist_ok=True)
+        with open(tmp_path / "workspace" / path, "w") as f:
+            f.write(contents)
+
+    # Same as `LC_ALL=C find src top.txt -type f -print0 | sort -z | xargs -0 sha1sum | sha1sum`
+    assert compute_hash_from_paths(["src", "top.txt"]) == "9d2c1de655cd4256f4a54643ac42bb301ff9ef9e"
@@ -0,0 +1,131 @@
+import os
+import threading
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from brick import __main__ as main
+from brick import lib
+from brick.__main__ import run_in_dependency_order, run_targets_in_parallel
+
+
+class RecordingRun:
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.started = []
+        self.lock = threading.Lock()
+
+    def __call__(self, target):
+        with self.lock:
+            self.started.append(target)
+        if target in self.failing:
+            raise Exception(f"{target} failed")
+
+
+def test_run_in_dependency_order():
+    run = RecordingRun()
+    run_in_dependency_order(run, {"app": ["lib", "utils"], "lib": ["utils"], "utils": []}, jobs=2)
+    assert run.started == ["utils", "lib", "app"]
+
+    # Independent targets all run
+    run = RecordingRun()
+    run_in_dependency_order(run, {"a": [], "b": [], "c": ["a"]}, jobs=2)
+    assert sorted(run.started) == ["a", "b", "c"]
+    assert run.started.index("a") < run.started.index("c")
+
+
+def test_run_in_dependency_order_with_circular_dependencies():
+    run = RecordingRun()
+    with pytest.raises(Exception) as excinfo:
+        run_in_dependency_order(run, {"a": ["b"], "b": ["a"], "c": []}, jobs=2)
+    assert "Found circular dependencies between ['a', 'b']" in str(excinfo.value)
+    assert run.started == ["c"]
+
+
+def test_run_in_dependency_order_propagates_failures():
+    run = RecordingRun(failing=["lib"])
+    with pytest.raises(Exception) as excinfo:
+        run_in_dependency_order(run, {"app": ["lib"], "lib": []}, jobs=2)
+    assert "lib failed" in str(excinfo.value)
+    # Dependents of a failed target never start
+    assert run.started == ["lib"]
+
+
+def test_run_targets_in_parallel(monkeypatch):
+    app, lib, utils = [os.path.join(main.ROOT_PATH, x) for x in ["app", "lib", "utils"]]
+    graph = {app: [lib], lib: [utils], utils: []}
+    monkeypatch.setattr(main, "get_build_dependencies", lambda t: graph[t])
+    run = RecordingRun()
+
+    @click.command()
+    @click.argument("target")
+    def stub_build(target, skip_previous_steps=None):
+        run((os.path.relpath(target, start=main.ROOT_PATH), skip_previous_steps))
+
+    monkeypatch.setattr(main, "build", stub_build)
+    ctx = click.Context(stub_build, parent=click.Context(main.cli))
+    ctx.parent.params = {"skip_previous_steps": True}
+
+    # Targets wait for the targets they depend on, even through other targets
+    run_targets_in_parallel(ctx, stub_build, [app, utils], jobs=2)
+    assert run.started == [("utils", True), ("app", True)]
+
+    graph[utils] = [app]
+    with pytest.raises(Exception) as excinfo:
+        run_targets_in_parallel(ctx, stub_build, [app], jobs=2)
+    assert "Found circular dependencies between ['app', 'lib', 'utils']" in str(excinfo.value)
+
+
+@pytest.fixture
+def workspace(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(lib, "ROOT_PATH", str(tmp_path))
+    monkeypatch.setattr(main, "ROOT_PATH", str(tmp_path))
+    monkeypatch.setattr(main, "get_git_branch", lambda: "master")
+    # cli sets the log levels, which other tests rely on
+    levels = main.logger.level, main.handler.level
+    yield tmp_path
+    main.logger.setLevel(levels[0])
+    main.handler.setLevel(levels[1])
+
+
+def write_targets(workspace, dependencies):
+    # Targets build from the outputs of their dependencies
+    for name, target_dependencies in dependencies.items():
+        os.makedirs(workspace / name)
+        with open(workspace / name / "BUILD.yaml", "w") as f:
+            f.write(
+                f"name: {name}\n"
+                "steps:\n"
+                "  build:\n"
+                "    image: alpine\n"
+                f"    inputs: {[f'../{x}/out' for x in target_dependencies]}\n"
+                "    outputs: [out]\n"
+            )
+
+
+def invoke_cli(*args):
+    # Deadlocks fail the test instead of hanging it
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(CliRunner().invoke(main.cli, args)), daemon=True
+    )
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), f"brick {' '.join(args)} deadlocked"
+    return results[0]
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_build_with_circular_dependencies(workspace, jobs):
+    write_targets(workspace, {"a": ["b"], "b": ["a"]})
+    result = invoke_cli("-j", jobs, "build", str(workspace / "a"))
+    assert "Found circular dependencies between ['a', 'b']" in str(result.exception)
+
+
+def test_build_with_circular_dependencies_built_in_parallel(workspace):
+    # b and c would each be built by a thread waiting for the other one
+    write_targets(workspace, {"a": ["b", "c"], "b": ["c"], "c": ["b"]})
+    result = invoke_cli("-j2", "build", str(workspace / "a"))
+    assert "Found circular dependencies between ['a', 'b', 'c']" in str(result.exception)